@@ -1,8 +1,32 @@
+# Backfills every season's Sleeper transactions into Supabase.
+#
+# Requirements (not installed by the KTC workflow):
+#   pip install "httpx[http2]" orjson tenacity requests supabase
+#   pip install "psycopg[binary]"   # optional, for the COPY path (SUPABASE_DB_URL)
+
+import os
 import time
+import json
+import asyncio
 import datetime # Added import
+import functools
+from pathlib import Path
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import httpx
+import orjson
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 from supabase import create_client, Client
 
+# Optional: only needed for the COPY bulk-load path
+try:
+    import psycopg
+    from psycopg import sql
+    from psycopg.types.json import Jsonb
+except ImportError:
+    psycopg = None
+
 # ---------- CONFIG ----------
 
 STARTING_LEAGUE_ID = "1180559121900638208" 
@@ -12,99 +36,421 @@ SUPABASE_SERVICE_KEY = "sb_publishable_z6H9o_SOKq4VngF2JD3Peg_5NmwjMfW"
 TRANSACTIONS_TABLE = "transactions" 
 WEEKS_TO_FETCH = 18 
 
+# Rows are keyed on Sleeper's transaction_id so re-running the backfill
+# updates instead of duplicating. Rows stored by older versions of this
+# script have no such column and may already be duplicated, so migrate with
+# (in this order: dedupe, fill in the key, then make it unique):
+TRANSACTIONS_MIGRATION = """\
+ALTER TABLE transactions ADD COLUMN IF NOT EXISTS transaction_id text;
+DELETE FROM transactions a USING transactions b
+  WHERE a.data->>'transaction_id' = b.data->>'transaction_id' AND a.id > b.id;
+UPDATE transactions SET transaction_id = data->>'transaction_id' WHERE transaction_id IS NULL;
+ALTER TABLE transactions ADD CONSTRAINT transactions_transaction_id_key UNIQUE (transaction_id);"""
+TRANSACTIONS_CONFLICT_KEY = "transaction_id"
+UPSERT_CHUNK_SIZE = 1000
+
+# Direct Postgres connection string (Supabase > Project Settings > Database).
+# When set, large loads of new rows use COPY instead of REST inserts
+SUPABASE_DB_URL = os.environ.get("SUPABASE_DB_URL")
+COPY_MIN_ROWS = 1000
+TRANSACTIONS_COLUMNS = (
+    "transaction_id", "league_id", "season", "week", "type", "executed_at", "data",
+)
+
+# Finished seasons never change, so their league metadata is kept on disk
+LEAGUE_CACHE_DIR = Path(".cache/sleeper")
+# Per league: the first week that was still open on the last clean run.
+# Weeks below it, empty or not, were complete when saved and can be skipped
+SYNCED_WEEKS_PATH = LEAGUE_CACHE_DIR / "synced_weeks.json"
+
+# Max in-flight Sleeper requests (replaces the old per-week sleep)
+MAX_CONCURRENT_REQUESTS = 8
+# Max seasons being fetched/written at once
+MAX_CONCURRENT_SEASONS = 4
+
 # ---------- SCRIPT LOGIC ----------
 
+UTC = datetime.timezone.utc
+
 if "YOUR_SERVICE_ROLE_KEY" in SUPABASE_SERVICE_KEY:
     print("ERROR: You must paste your Supabase Service Role Key into the script.")
     exit(1)
 
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
 
-def get_league_details(league_id):
+# Writes go straight to PostgREST so the payload can be encoded with orjson
+TRANSACTIONS_REST_URL = f"{SUPABASE_URL}/rest/v1/{TRANSACTIONS_TABLE}"
+REST_HEADERS = {
+    "apikey": SUPABASE_SERVICE_KEY,
+    "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
+    "Content-Type": "application/json",
+}
+
+# Keep-alive session for the synchronous Sleeper and PostgREST calls
+SESSION = requests.Session()
+adapter = HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504]),
+)
+SESSION.mount("https://", adapter)
+
+# Shared across all week fetches, created in main()
+session: httpx.AsyncClient = None
+request_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+season_semaphore = asyncio.Semaphore(MAX_CONCURRENT_SEASONS)
+# league_id -> first open week on the last clean run, loaded in main()
+synced_weeks = {}
+
+@functools.lru_cache(maxsize=None)
+def load_league_details(league_id):
+    # Raises on any failure so lru_cache only ever keeps successful lookups
+    cache_path = LEAGUE_CACHE_DIR / f"{league_id}.json"
+    if cache_path.exists():
+        try:
+            return json.loads(cache_path.read_text())
+        except ValueError:
+            print(f"  [Cache] ignoring unreadable {cache_path}")
+
     url = f"https://api.sleeper.app/v1/league/{league_id}"
-    resp = requests.get(url)
-    if resp.status_code != 200:
-        print(f"  [Error] Could not find league {league_id}")
+    resp = SESSION.get(url, timeout=20)
+    resp.raise_for_status()
+    meta = resp.json()
+    if not meta:
+        raise LookupError("no such league")
+
+    # Only finished seasons are safe to cache forever
+    if meta.get("status") == "complete":
+        LEAGUE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        cache_path.write_text(json.dumps(meta))
+    return meta
+
+def get_league_details(league_id):
+    try:
+        return load_league_details(league_id)
+    except Exception as e:
+        print(f"  [Error] Could not find league {league_id}: {e}")
         return None
-    return resp.json()
 
-def fetch_transactions(league_id, week):
+def is_retryable_error(e):
+    # Rate limits and transient server errors are worth another try
+    if not isinstance(e, httpx.HTTPStatusError):
+        return False
+    status = e.response.status_code
+    return status == 429 or status >= 500
+
+@retry(
+    retry=retry_if_exception(is_retryable_error),
+    wait=wait_exponential(multiplier=0.5, max=8),
+    stop=stop_after_attempt(3),
+    reraise=True,
+)
+async def fetch_transactions(session, league_id, week):
     url = f"https://api.sleeper.app/v1/league/{league_id}/transactions/{week}"
-    resp = requests.get(url)
+    async with request_semaphore:
+        resp = await session.get(url)
+    if resp.status_code == 429 or resp.status_code >= 500:
+        resp.raise_for_status()
     if resp.status_code != 200:
+        print(f"    [Fetch Error] Week {week}: HTTP {resp.status_code}, skipping")
         return []
     return resp.json()
 
+def ms_to_iso(ms):
+    # Sleeper sends epoch ms. Convert in UTC with an explicit offset so the
+    # timestamp column doesn't depend on the machine running the backfill
+    return datetime.datetime.fromtimestamp(ms / 1000, UTC).isoformat()
+
+async def fetch_week(session, league_id, week):
+    # A week that still fails after retries shouldn't sink the whole season;
+    # None (rather than []) tells the caller the week is still unknown
+    try:
+        return await fetch_transactions(session, league_id, week)
+    except Exception as e:
+        print(f"    [Fetch Error] Week {week}: {e}")
+        return None
+
+def get_existing_weeks(league_id):
+    # PostgREST has no DISTINCT, so hop from week to week: each request
+    # returns just the next stored week, ~1 tiny request per stored week
+    weeks = set()
+    last_week = 0
+    while True:
+        try:
+            resp = (
+                supabase.table(TRANSACTIONS_TABLE)
+                .select("week")
+                .eq("league_id", league_id)
+                .gt("week", last_week)
+                .order("week")
+                .limit(1)
+                .execute()
+            )
+        except Exception as e:
+            print(f"    [DB Error] {e}")
+            return set()
+        if not resp.data:
+            return weeks
+        last_week = resp.data[0]["week"]
+        weeks.add(last_week)
+
+def load_synced_weeks():
+    if not SYNCED_WEEKS_PATH.exists():
+        return {}
+    try:
+        return json.loads(SYNCED_WEEKS_PATH.read_text())
+    except ValueError:
+        print(f"  [Cache] ignoring unreadable {SYNCED_WEEKS_PATH}")
+        return {}
+
+def save_synced_week(league_id, week):
+    synced_weeks[league_id] = week
+    LEAGUE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    SYNCED_WEEKS_PATH.write_text(json.dumps(synced_weeks, indent=2))
+
+def get_current_week(meta):
+    # Weeks before this one can't pick up new transactions
+    if meta.get("status") == "complete":
+        return WEEKS_TO_FETCH + 1
+    return (meta.get("settings") or {}).get("leg") or 1
+
+def post_rows(rows, prefer, params=None):
+    # The raw Sleeper payloads in "data" make these bodies large; orjson
+    # encodes them much faster than the stdlib json supabase-py uses
+    resp = SESSION.post(
+        TRANSACTIONS_REST_URL,
+        data=orjson.dumps(rows),
+        params=params,
+        headers={**REST_HEADERS, "Prefer": prefer},
+        timeout=60,
+    )
+    resp.raise_for_status()
+
+def check_transactions_schema():
+    # Every write targets transaction_id; fail up front if the column is
+    # missing or old rows were never keyed (they'd never conflict, so the
+    # upserts would store every one of them a second time)
+    try:
+        resp = (
+            supabase.table(TRANSACTIONS_TABLE)
+            .select(TRANSACTIONS_CONFLICT_KEY)
+            .is_(TRANSACTIONS_CONFLICT_KEY, "null")
+            .limit(1)
+            .execute()
+        )
+        problem = "has rows with no value" if resp.data else None
+    except Exception as e:
+        problem = f"is not usable ({e})"
+    if problem:
+        print(f"ERROR: {TRANSACTIONS_TABLE}.{TRANSACTIONS_CONFLICT_KEY} {problem}.")
+        print("  Run this migration first:")
+        print(TRANSACTIONS_MIGRATION)
+        exit(1)
+
 def upsert_batch(rows):
-    if not rows: return
+    if not rows: return True
     try:
-        supabase.table(TRANSACTIONS_TABLE).upsert(rows).execute()
+        post_rows(
+            rows,
+            "resolution=merge-duplicates,return=minimal",
+            params={"on_conflict": TRANSACTIONS_CONFLICT_KEY},
+        )
+        return True
     except Exception as e:
         print(f"    [DB Error] {e}")
+        return False
 
-def process_season(league_id):
+def insert_batch(rows):
+    if not rows: return True
+    try:
+        post_rows(rows, "return=minimal")
+        return True
+    except Exception as e:
+        # Something in the chunk already exists; let the upsert sort it out
+        print(f"    [DB Error] insert failed, retrying as upsert: {e}")
+        return upsert_batch(rows)
+
+def copy_rows(rows):
+    # COPY into a temp table shaped like the real one, then merge with a
+    # single INSERT ... ON CONFLICT; far less overhead than REST for big loads
+    table = sql.Identifier(TRANSACTIONS_TABLE)
+    columns = sql.SQL(", ").join(map(sql.Identifier, TRANSACTIONS_COLUMNS))
+    updates = sql.SQL(", ").join(
+        sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(c))
+        for c in TRANSACTIONS_COLUMNS
+        if c != TRANSACTIONS_CONFLICT_KEY
+    )
+
+    with psycopg.connect(SUPABASE_DB_URL) as conn, conn.cursor() as cur:
+        cur.execute(
+            sql.SQL(
+                "CREATE TEMP TABLE tx_stage ON COMMIT DROP AS "
+                "SELECT {columns} FROM {table} WITH NO DATA"
+            ).format(columns=columns, table=table)
+        )
+        # Text format lets Postgres cast to whatever types the table uses
+        copy_sql = sql.SQL("COPY tx_stage ({columns}) FROM STDIN").format(columns=columns)
+        with cur.copy(copy_sql) as copy:
+            for r in rows:
+                copy.write_row([
+                    Jsonb(r[c]) if c == "data" else r[c] for c in TRANSACTIONS_COLUMNS
+                ])
+        cur.execute(
+            sql.SQL(
+                "INSERT INTO {table} ({columns}) SELECT {columns} FROM tx_stage "
+                "ON CONFLICT ({key}) DO UPDATE SET {updates}"
+            ).format(
+                table=table,
+                columns=columns,
+                key=sql.Identifier(TRANSACTIONS_CONFLICT_KEY),
+                updates=updates,
+            )
+        )
+
+def save_season(new_rows, changed_rows):
+    # Returns (rows saved, rows in chunks that failed)
+    saved = 0
+    failed = 0
+
+    # Big historical loads go over COPY when a direct DB connection is set up
+    if new_rows and SUPABASE_DB_URL and psycopg and len(new_rows) >= COPY_MIN_ROWS:
+        try:
+            copy_rows(new_rows)
+            saved += len(new_rows)
+            new_rows = []
+        except Exception as e:
+            print(f"    [DB Error] COPY failed, falling back to REST: {e}")
+
+    # One round-trip per chunk instead of one per week. Plain inserts skip
+    # the conflict check, so only weeks already in the table get upserted
+    chunks = [
+        (insert_batch, new_rows[i : i + UPSERT_CHUNK_SIZE])
+        for i in range(0, len(new_rows), UPSERT_CHUNK_SIZE)
+    ] + [
+        (upsert_batch, changed_rows[i : i + UPSERT_CHUNK_SIZE])
+        for i in range(0, len(changed_rows), UPSERT_CHUNK_SIZE)
+    ]
+    for write, chunk in chunks:
+        if write(chunk):
+            saved += len(chunk)
+        else:
+            failed += len(chunk)
+
+    return saved, failed
+
+def get_league_chain(league_id):
+    # Metadata only, so walking back is cheap; seasons are fetched afterwards
+    league_ids = []
+    current_id = league_id
+
+    while current_id:
+        meta = get_league_details(current_id)
+        if not meta: break
+        league_ids.append(current_id)
+
+        prev_id = meta.get("previous_league_id")
+        if prev_id and prev_id != "0":
+            print(f"  Found previous season! Walking back to {prev_id}...")
+            current_id = prev_id
+        else:
+            print("\nReached the beginning of the league (no previous ID found).")
+            break
+
+    return league_ids
+
+async def process_season(league_id):
+    async with season_semaphore:
+        return await load_season(league_id)
+
+async def load_season(league_id):
+    # Already cached by the chain walk
     meta = get_league_details(league_id)
-    if not meta: return None
 
     season_year = meta.get("season")
-    prev_id = meta.get("previous_league_id")
     name = meta.get("name", "Unknown League")
 
     print(f"\nProcessing {season_year} Season...")
     print(f"  League: {name} (ID: {league_id})")
 
-    total_season_tx = 0
+    # Keyed by transaction_id so a repeated transaction is only sent once
+    new_rows = {}
+    changed_rows = {}
+
+    # Weeks that were already over on the last clean run are fully stored,
+    # including the ones that had no transactions. The week that was open
+    # then may have gained transactions since. A league with no stored rows
+    # at all (e.g. a wiped table) is fetched in full regardless
+    existing = await asyncio.to_thread(get_existing_weeks, league_id)
+    current_week = get_current_week(meta)
+    synced_week = synced_weeks.get(league_id, 1) if existing else 1
+    weeks = list(range(synced_week, WEEKS_TO_FETCH + 1))
+    if len(weeks) < WEEKS_TO_FETCH:
+        print(f"  {season_year}: skipping {WEEKS_TO_FETCH - len(weeks)} weeks already loaded")
 
-    for week in range(1, WEEKS_TO_FETCH + 1):
-        txs = fetch_transactions(league_id, week)
-        
+    # Fire every week at once; the semaphore keeps us polite
+    tasks = [fetch_week(session, league_id, w) for w in weeks]
+    results = await asyncio.gather(*tasks)
+
+    fetch_failed = any(txs is None for txs in results)
+
+    for week, txs in zip(weeks, results):
         if not txs:
             continue
 
-        rows = []
+        # Weeks with nothing stored yet can be plain inserts
+        rows = changed_rows if week in existing else new_rows
         for t in txs:
             # Timestamp fallback
             raw_ts = t.get("status_updated") or t.get("created") or int(time.time() * 1000)
-            
-            # Fix: Convert ms integer to ISO string
-            dt_obj = datetime.datetime.fromtimestamp(raw_ts / 1000.0)
-            iso_ts = dt_obj.isoformat()
+            iso_ts = ms_to_iso(raw_ts)
 
-            rows.append({
+            rows[t.get("transaction_id")] = {
+                "transaction_id": t.get("transaction_id"),
                 "league_id": league_id,
                 "season": season_year,
                 "week": week,
                 "type": t.get("type", "unknown"),
                 "executed_at": iso_ts, # Correct format for timestamp column
                 "data": t
-            })
+            }
 
-        if rows:
-            upsert_batch(rows)
-            total_season_tx += len(rows)
-            print(f"    Week {week}: Saved {len(rows)} transactions")
-        
-        time.sleep(0.2)
+        print(f"    {season_year} Week {week}: Collected {len(txs)} transactions")
 
-    print(f"  > Finished {season_year}: {total_season_tx} total transactions.")
-    return prev_id
+    # Blocking HTTP write; keep it off the loop so other seasons keep fetching
+    saved, failed = await asyncio.to_thread(
+        save_season, list(new_rows.values()), list(changed_rows.values())
+    )
+    if failed:
+        print(f"  > Finished {season_year}: saved {saved} transactions, FAILED to save {failed}.")
+    else:
+        print(f"  > Finished {season_year}: {saved} total transactions.")
 
-def main():
+    # Everything before current_week is now stored in full
+    if not failed and not fetch_failed:
+        save_synced_week(league_id, current_week)
+    return failed
+
+async def main():
+    global session, synced_weeks
     print("=== STARTING FULL HISTORY BACKFILL ===")
     
-    current_id = STARTING_LEAGUE_ID
-    
-    while current_id:
-        prev_id = process_season(current_id)
-        
-        if prev_id and prev_id != "0":
-            print(f"  Found previous season! Walking back to {prev_id}...")
-            current_id = prev_id
-        else:
-            print("\nReached the beginning of the league (no previous ID found).")
-            break
+    # HTTP/2 multiplexes every week fetch over one connection
+    limits = httpx.Limits(
+        max_connections=MAX_CONCURRENT_REQUESTS,
+        max_keepalive_connections=MAX_CONCURRENT_REQUESTS,
+    )
+    check_transactions_schema()
+    synced_weeks = load_synced_weeks()
+    league_ids = get_league_chain(STARTING_LEAGUE_ID)
+
+    async with httpx.AsyncClient(http2=True, limits=limits, timeout=20) as session:
+        # Seasons are independent once the chain is known
+        failures = await asyncio.gather(*(process_season(lid) for lid in league_ids))
 
+    if sum(failures):
+        print(f"\n=== HISTORY INCOMPLETE: {sum(failures)} transactions failed to save ===")
+        exit(1)
     print("\n=== HISTORY COMPLETE ===")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file
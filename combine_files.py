@@ -1,4 +1,6 @@
 import os
+import shutil
+import tempfile
 
 # Configuration
 output_filename = "full_project_context.txt"
@@ -6,16 +8,21 @@ output_filename = "full_project_context.txt"
 allowed_extensions = {".html", ".css", ".js", ".json", ".py", ".txt"}
 # Add any specific filenames you want to ignore
 ignored_files = {output_filename, "combine_files.py", ".DS_Store"}
+# Read/write buffer size for streaming file contents
+buffer_size = 1024 * 1024
 
 def main():
     # Get the current directory where the script is located
     current_dir = os.getcwd()
     
-    with open(output_filename, "w", encoding="utf-8") as outfile:
+    with open(output_filename, "w", encoding="utf-8", buffering=buffer_size) as outfile, \
+            os.scandir(current_dir) as entries:
         # Loop through all files in the directory
-        for filename in os.listdir(current_dir):
-            # Skip directories
-            if not os.path.isfile(filename):
+        for entry in entries:
+            filename = entry.name
+
+            # Skip directories (DirEntry caches this, no extra stat)
+            if not entry.is_file():
                 continue
 
             # Skip ignored files
@@ -28,12 +35,17 @@ def main():
                 continue
 
             try:
-                with open(filename, "r", encoding="utf-8") as infile:
-                    content = infile.read()
-                    
-                    # Write the header and content
+                with open(entry.path, "r", encoding="utf-8", buffering=buffer_size) as infile, \
+                        tempfile.SpooledTemporaryFile(buffer_size, "w+", encoding="utf-8") as staged:
+                    # Decode the whole file into a spool first (memory up to
+                    # buffer_size, then disk) so an undecodable file is skipped
+                    # before any of it reaches the output
+                    shutil.copyfileobj(infile, staged, buffer_size)
+                    staged.seek(0)
+
+                    # Write the header and stream the content across
                     outfile.write(f"=== START FILE: {filename} ===\n")
-                    outfile.write(content)
+                    shutil.copyfileobj(staged, outfile, buffer_size)
                     outfile.write(f"\n=== END FILE: {filename} ===\n\n")
                     print(f"Processed: {filename}")
             
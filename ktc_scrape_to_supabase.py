@@ -1,9 +1,13 @@
 import os
-import time
+import json
+import asyncio
 import datetime as dt
-from typing import List, Dict
-import requests
-from bs4 import BeautifulSoup
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+import httpx
+from selectolax.lexbor import LexborHTMLParser
+from postgrest.types import ReturnMethod
 from supabase import create_client, Client
 
 # -----------------------------------------------------------------------------
@@ -18,6 +22,20 @@ KTC_FORMAT = "superflex"
 # How many pages to scrape? (0-9 covers top 1000 players, which is plenty)
 MAX_PAGES = 10 
 
+# Pages fetched at once (be polite to KTC server)
+MAX_CONCURRENT_PAGES = 4
+
+# Rows per PostgREST request, and how many requests to keep in flight
+UPSERT_BATCH_SIZE = 1000
+MAX_CONCURRENT_UPSERTS = 4
+
+# Parsed rows waiting to be uploaded; caps memory no matter how many pages
+ROW_QUEUE_SIZE = 2000
+
+# ETag / Last-Modified per page URL from the last successful run, so
+# unchanged pages come back as an empty 304 (kept by the workflow cache)
+ETAG_CACHE_PATH = Path(".cache/ktc_etags.json")
+
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_SERVICE_ROLE_KEY = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
 
@@ -35,68 +53,104 @@ if SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY:
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
     "Accept-Language": "en-US,en;q=0.9",
+    # No Accept-Encoding: httpx sends its own, listing br only when the
+    # Brotli package is installed, so it can always decode the response
 }
 
-def fetch_ktc_page(page_num: int) -> str:
+def load_etags() -> Dict[str, Dict[str, str]]:
+    if not ETAG_CACHE_PATH.exists():
+        return {}
+    try:
+        return json.loads(ETAG_CACHE_PATH.read_text())
+    except ValueError:
+        print("[ktc] WARNING: ignoring unreadable etag cache")
+        return {}
+
+def save_etags(etags: Dict[str, Dict[str, str]]) -> None:
+    ETAG_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    ETAG_CACHE_PATH.write_text(json.dumps(etags, indent=2))
+
+async def fetch_ktc_page(
+    session: httpx.AsyncClient, page_num: int, etags: Dict[str, Dict[str, str]]
+) -> Optional[str]:
     url = KTC_BASE_URL.format(page=page_num)
     print(f"[ktc] fetching page {page_num}: {url}")
-    resp = requests.get(url, headers=HEADERS, timeout=20)
+
+    cached = etags.get(url, {})
+    headers = {}
+    if cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+
+    resp = await session.get(url, headers=headers)
+    if resp.status_code == 304:
+        print(f"[ktc] page {page_num} not modified since last run")
+        return None
     resp.raise_for_status()
+    encoding = resp.headers.get("Content-Encoding", "identity")
+    print(f"[ktc] page {page_num} {resp.http_version} content-encoding: {encoding}")
+
+    validators = {
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+    }
+    etags[url] = {k: v for k, v in validators.items() if v}
     return resp.text
 
-def parse_ktc_table(html: str) -> List[Dict]:
-    soup = BeautifulSoup(html, "html.parser")
-    results: List[Dict] = []
-    today = dt.date.today()
+def iter_ktc_rows(html: str) -> Iterator[Dict]:
+    tree = LexborHTMLParser(html)
+    # Same date for every row, so format it once
+    today_iso = dt.date.today().isoformat()
 
     # 1. Find the main container
-    container = soup.select_one("#rankings-page-rankings")
+    container = tree.css_first("#rankings-page-rankings")
     if not container:
         print("[ktc] WARNING: Could not find #rankings-page-rankings container")
-        return []
+        return
 
     # 2. Find direct children divs (The players) safely
-    player_rows = container.find_all("div", recursive=False)
+    player_rows = [node for node in container.iter() if node.tag == "div"]
 
     for row in player_rows:
         # Check if this div is actually a player row (it should have a name)
-        name_el = row.select_one(".player-name a")
+        name_el = row.css_first(".player-name a")
         if not name_el:
             continue
 
         # --- Extract Data ---
-        player_name = name_el.get_text(strip=True)
+        player_name = name_el.text(strip=True)
         
         # Team
-        team_el = row.select_one(".player-team")
-        nfl_team = team_el.get_text(strip=True) if team_el else "FA"
+        team_el = row.css_first(".player-team")
+        nfl_team = team_el.text(strip=True) if team_el else "FA"
 
         # Position
-        pos_el = row.select_one("p.position")
-        position = pos_el.get_text(strip=True) if pos_el else "UNK"
+        pos_el = row.css_first("p.position")
+        position = pos_el.text(strip=True) if pos_el else "UNK"
 
         # Value
-        value_el = row.select_one(".value p")
+        value_el = row.css_first(".value p")
         if not value_el: 
             continue
         try:
-            ktc_value = int(value_el.get_text(strip=True).replace(",", ""))
+            ktc_value = int(value_el.text(strip=True).replace(",", ""))
         except ValueError:
             continue
 
         # Rank
-        rank_el = row.select_one(".rank-number p")
+        rank_el = row.css_first(".rank-number p")
         try:
-            ktc_rank = int(rank_el.get_text(strip=True)) if rank_el else 999
+            ktc_rank = int(rank_el.text(strip=True)) if rank_el else 999
         except ValueError:
             ktc_rank = 999
 
         # ID Generation (Slug)
-        href = name_el.get("href", "")
+        href = name_el.attributes.get("href") or ""
         slug = href.split("/")[-1] if href else f"{player_name}_{position}"
         ktc_player_id = slug.lower()
 
-        results.append({
+        yield {
             "ktc_player_id": ktc_player_id,
             "player_name": player_name,
             "position": position,
@@ -104,61 +158,157 @@ def parse_ktc_table(html: str) -> List[Dict]:
             "format": KTC_FORMAT,
             "ktc_rank": ktc_rank,
             "ktc_value": ktc_value,
-            "as_of_date": today.isoformat(),
-        })
+            "as_of_date": today_iso,
+        }
 
-    return results
+def parse_ktc_table(html: str) -> List[Dict]:
+    # Materialized so a whole page can come back from a worker process
+    return list(iter_ktc_rows(html))
 
 # -----------------------------------------------------------------------------
 # Supabase upsert
 # -----------------------------------------------------------------------------
 
-def upsert_ktc_values(rows: List[Dict]) -> None:
-    if not rows:
-        print("[ktc] no rows to upsert")
-        return
-    
+def post_batch(batch: List[Dict], start: int) -> bool:
+    try:
+        # minimal: don't make PostgREST echo every row back
+        supabase.table("ktc_values").upsert(
+            batch,
+            on_conflict="ktc_player_id,format,as_of_date",
+            returning=ReturnMethod.minimal,
+        ).execute()
+        print(f"   - batch {start} to {start+len(batch)} success")
+        return True
+    except Exception as e:
+        print(f"[ktc] Error upserting batch {start}: {e}")
+        return False
+
+async def upload_rows(queue: asyncio.Queue) -> Tuple[int, bool]:
+    # Drain parsed rows and upsert them in batches while scraping continues
     if not supabase:
         print("[ktc] Supabase client not initialized, skipping upsert.")
-        return
 
-    print(f"[ktc] upserting {len(rows)} rows to supabase...")
+    sem = asyncio.Semaphore(MAX_CONCURRENT_UPSERTS)
+    uploads = []
+    seen = set()
+    batch: List[Dict] = []
+    total = 0
+    dropped = 0
 
-    # Batch upsert to handle larger datasets (500+ rows) smoothly
-    batch_size = 200
-    for i in range(0, len(rows), batch_size):
-        batch = rows[i : i + batch_size]
+    async def flush(chunk: List[Dict], start: int) -> bool:
         try:
-            supabase.table("ktc_values").upsert(
-                batch, on_conflict="ktc_player_id,format,as_of_date"
-            ).execute()
-            print(f"   - batch {i} to {i+len(batch)} success")
-        except Exception as e:
-            print(f"[ktc] Error upserting batch {i}: {e}")
+            # The supabase client is sync, so run it on a worker thread
+            return await asyncio.to_thread(post_batch, chunk, start)
+        finally:
+            sem.release()
 
-    print("[ktc] finished.")
+    async def dispatch(chunk: List[Dict], start: int) -> None:
+        if not supabase:
+            return
+        # Waiting here backs up the queue, which in turn pauses the scraper
+        await sem.acquire()
+        uploads.append(asyncio.create_task(flush(chunk, start)))
+
+    while True:
+        row = await queue.get()
+        if row is None:
+            break
+
+        # A player listed on two pages would make PostgREST reject the whole
+        # batch ("cannot affect row a second time"), so keep the first copy
+        key = (row["ktc_player_id"], row["format"], row["as_of_date"])
+        if key in seen:
+            dropped += 1
+            continue
+        seen.add(key)
+
+        batch.append(row)
+        if len(batch) >= UPSERT_BATCH_SIZE:
+            await dispatch(batch, total)
+            total += len(batch)
+            batch = []
+
+    if batch:
+        await dispatch(batch, total)
+        total += len(batch)
+
+    results = await asyncio.gather(*uploads)
+
+    if dropped:
+        print(f"[ktc] dropped {dropped} duplicate rows")
+    return total, bool(supabase) and all(results)
+
+async def scrape_rows(queue: asyncio.Queue, etags: Dict[str, Dict[str, str]]) -> None:
+    # Rows are queued in page order so the empty-page cutoff still holds
+    sem = asyncio.Semaphore(MAX_CONCURRENT_PAGES)
+    # HTTP/2 multiplexes all page fetches over one connection
+    limits = httpx.Limits(
+        max_connections=MAX_CONCURRENT_PAGES,
+        max_keepalive_connections=MAX_CONCURRENT_PAGES,
+    )
+    loop = asyncio.get_running_loop()
+
+    # Parsing is CPU-bound, so spread the pages across cores
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+        async with httpx.AsyncClient(
+            http2=True,
+            headers=HEADERS,
+            limits=limits,
+            timeout=20,
+            follow_redirects=True,
+        ) as session:
+            async def fetch_and_parse(page: int) -> Optional[List[Dict]]:
+                async with sem:
+                    html = await fetch_ktc_page(session, page, etags)
+                if html is None:
+                    return None
+                return await loop.run_in_executor(pool, parse_ktc_table, html)
+
+            # Pages are independent, so start them all up front
+            tasks = [asyncio.create_task(fetch_and_parse(p)) for p in range(MAX_PAGES)]
+            try:
+                for page, task in enumerate(tasks):
+                    page_rows = await task
+
+                    # Unchanged since last run: the stored rows are still current
+                    if page_rows is None:
+                        continue
+
+                    if not page_rows:
+                        print(f"[ktc] Page {page} returned 0 rows. Stopping.")
+                        # Nothing past here gets stored, so don't let a 304
+                        # skip these pages next time
+                        for p in range(page, MAX_PAGES):
+                            etags.pop(KTC_BASE_URL.format(page=p), None)
+                        break
+
+                    print(f"[ktc] Page {page} parsed {len(page_rows)} rows.")
+                    for row in page_rows:
+                        await queue.put(row)
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+    await queue.put(None)
+
+async def scrape_and_upload(etags: Dict[str, Dict[str, str]]) -> Tuple[int, bool]:
+    # Uploads start as soon as the first page is parsed
+    queue: asyncio.Queue = asyncio.Queue(maxsize=ROW_QUEUE_SIZE)
+    _, result = await asyncio.gather(scrape_rows(queue, etags), upload_rows(queue))
+    return result
 
 def main():
-    all_rows = []
-    
     try:
-        # Loop through pages
-        for page in range(MAX_PAGES):
-            html = fetch_ktc_page(page)
-            page_rows = parse_ktc_table(html)
-            
-            if not page_rows:
-                print(f"[ktc] Page {page} returned 0 rows. Stopping.")
-                break
-            
-            print(f"[ktc] Page {page} parsed {len(page_rows)} rows.")
-            all_rows.extend(page_rows)
-            
-            # Be polite to KTC server
-            time.sleep(2)
-
-        print(f"[ktc] Total rows collected: {len(all_rows)}")
-        upsert_ktc_values(all_rows)
+        etags = load_etags()
+        total, uploaded = asyncio.run(scrape_and_upload(etags))
+
+        print(f"[ktc] Total rows collected: {total}")
+
+        # Only remember validators once the rows behind them are stored,
+        # otherwise a failed upload would be skipped as a 304 next time
+        if uploaded:
+            save_etags(etags)
+        print("[ktc] finished.")
 
     except Exception as e:
         print(f"[ktc] CRITICAL ERROR: {e}")
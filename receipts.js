@@ -9,12 +9,24 @@
 //   - Supabase transactions table (pre-scraped via backend script):
 //       Expected columns (minimal):
 //         league_id    (text)
+//         transaction_id (text, unique) – Sleeper transaction id
 //         season       (text or int)
 //         week         (int)
 //         type         (text: "trade", "waiver", "free_agent", "faab_bid", etc.)
 //         executed_at  (timestamp / text)
 //         data         (jsonb) – raw Sleeper transaction payload
 //
+//       transaction_id must be filled in and unique (the backfill upserts
+//       on it). Older backfills left it out and may have stored duplicates,
+//       so dedupe and fill it in before adding the constraint:
+//         ALTER TABLE transactions ADD COLUMN IF NOT EXISTS transaction_id text;
+//         DELETE FROM transactions a USING transactions b
+//           WHERE a.data->>'transaction_id' = b.data->>'transaction_id' AND a.id > b.id;
+//         UPDATE transactions SET transaction_id = data->>'transaction_id'
+//           WHERE transaction_id IS NULL;
+//         ALTER TABLE transactions
+//           ADD CONSTRAINT transactions_transaction_id_key UNIQUE (transaction_id);
+//
 //   - KTC client:
 //       window.KTCClient.getBestValueForSleeperId(playerId)
 //